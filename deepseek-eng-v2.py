@@ -1,71 +1,106 @@
 #!/usr/bin/env python3
 
+import io
 import os
+import re
 import sys
 import json
+import itertools
+from dataclasses import dataclass
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from textwrap import dedent
 from typing import List, Dict, Any, Optional, Tuple
+import httpx
 from openai import OpenAI
-from pydantic import BaseModel
 from dotenv import load_dotenv
 from rich.console import Console
-from rich.table import Table
 from rich.panel import Panel
-from rich.style import Style
 import time
 
 # Force UTF-8 encoding for Windows console
 if sys.platform == "win32":
-    import io
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
 # Initialize Rich console
 console = Console()
 
+# Use tiktoken for accurate token counts when available
+@lru_cache(maxsize=1)
+def get_encoder():
+    """Load the tiktoken encoder once, on first use. Returns None if it is unavailable."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # Fall back to the character-based estimate
+        return None
+
+# Use orjson for faster JSON parsing when available
+try:
+    import orjson
+    json_loads = orjson.loads
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
 # Token limits and management
 MAX_CONTEXT_TOKENS = 50000  # Leave buffer for responses (API limit is 65536)
 MAX_FILE_TOKENS = 8000      # Max tokens per file
 MAX_FILES_PER_ADD = 20      # Max files to add at once
+MAX_MESSAGES = 30           # Trim history beyond this many messages
 CHARS_PER_TOKEN = 4         # Rough estimate
-
-# Try to initialize prompt session with fallback
-try:
-    from prompt_toolkit import PromptSession
-    from prompt_toolkit.styles import Style as PromptStyle
-    
-    prompt_session = PromptSession(
-        style=PromptStyle.from_dict({
-            'prompt': '#0066ff bold',  # Bright blue prompt
-            'completion-menu.completion': 'bg:#1e3a8a fg:#ffffff',
-            'completion-menu.completion.current': 'bg:#3b82f6 fg:#ffffff bold',
-        })
-    )
-    use_prompt_toolkit = True
-except Exception as e:
-    # Fallback for environments without proper console
-    console.print("[yellow]Note: Running in fallback mode (no auto-completion)[/yellow]")
-    prompt_session = None
-    use_prompt_toolkit = False
+MAX_IO_WORKERS = 8          # Max threads for concurrent file I/O
+COMPACT_AT_TOKENS = int(0.6 * MAX_CONTEXT_TOKENS)          # Summarize old turns once the unpinned tail passes this
+MAX_SUMMARY_INPUT_TOKENS = int(0.2 * MAX_CONTEXT_TOKENS)   # Max tokens sent to be summarized
+MAX_SUMMARY_TOKENS = 512    # Max tokens in a summary of old turns
+SUMMARY_EXCERPT_CHARS = 400 # File contents and tool payloads are cut to this before summarizing
+TOOL_RESULT_TURNS = 3       # Elide tool results older than this many turns
+MAX_TOOL_ROUNDS = 5         # Max rounds of function calls answered per user message
 
 # --------------------------------------------------------------------------------
 # 1. Configure OpenAI client and load environment variables
 # --------------------------------------------------------------------------------
 load_dotenv()  # Load environment variables from .env file
+
+def create_http_client() -> httpx.Client:
+    """Create a pooled HTTP client, using HTTP/2 when the 'h2' package is installed.
+
+    The initial and follow-up requests of a turn reuse its kept-alive
+    connection instead of repeating the TLS handshake.
+    """
+    options = {
+        # The read timeout applies between streamed chunks, not to the whole response
+        "timeout": httpx.Timeout(60.0, connect=5.0),
+        "limits": httpx.Limits(max_connections=16, max_keepalive_connections=8),
+    }
+    try:
+        # HTTP/2 multiplexes every request of the session over one connection
+        return httpx.Client(http2=True, **options)
+    except ImportError:
+        return httpx.Client(**options)
+
 client = OpenAI(
     api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"
+    base_url="https://api.deepseek.com",
+    http_client=create_http_client()
 )  # Configure for DeepSeek API
 
 # --------------------------------------------------------------------------------
-# 2. Define our schema using Pydantic for type safety
+# 2. Define our schema using lightweight dataclasses
 # --------------------------------------------------------------------------------
-class FileToCreate(BaseModel):
+@dataclass(slots=True, frozen=True)
+class FileToCreate:
     path: str
     content: str
 
-class FileToEdit(BaseModel):
+@dataclass(slots=True, frozen=True)
+class FileToEdit:
     path: str
     original_snippet: str
     new_snippet: str
@@ -184,6 +219,14 @@ tools = [
     }
 ]
 
+# Request options shared by the initial and follow-up completions of a turn
+STREAM_OPTIONS = {
+    "model": "deepseek-reasoner",
+    "tools": tools,
+    "max_completion_tokens": 64000,
+    "stream": True,
+}
+
 # --------------------------------------------------------------------------------
 # 3. system prompt
 # --------------------------------------------------------------------------------
@@ -231,21 +274,103 @@ def estimate_tokens(text: str) -> int:
     """Estimate the number of tokens in a text string."""
     if not text:
         return 0
+    encoder = get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
     # Rough estimate: ~4 characters per token
     # Add 10% buffer for safety
     return int(len(text) / CHARS_PER_TOKEN * 1.1)
 
-def get_conversation_tokens() -> int:
-    """Calculate total tokens in current conversation."""
-    total = 0
-    for msg in conversation_history:
-        if msg.get("content"):
-            total += estimate_tokens(msg["content"])
+def estimate_tokens_batch(texts: List[str]) -> List[int]:
+    """Estimate tokens for several strings at once. tiktoken encodes the batch in parallel."""
+    encoder = get_encoder()
+    if encoder is not None and len(texts) > 1:
+        return [len(ids) for ids in encoder.encode_batch(texts, num_threads=MAX_IO_WORKERS, disallowed_special=())]
+    return [estimate_tokens(text) for text in texts]
+
+def message_tokens(msg: Dict[str, Any]) -> int:
+    """Estimate the number of tokens used by a single conversation message.
+
+    The count is cached on the message under '_tokens'. Pop that key after
+    changing the message so it is recomputed.
+    """
+    total = msg.get("_tokens")
+    if total is None:
+        total = estimate_tokens(msg.get("content") or "")
         # Tool calls also use tokens
         if msg.get("tool_calls"):
-            total += estimate_tokens(json.dumps(msg["tool_calls"]))
+            total += estimate_tokens(json_dumps(msg["tool_calls"]))
+        msg["_tokens"] = total
     return total
 
+def append_message(msg: Dict[str, Any]) -> None:
+    """Append a message to the conversation and update the running token total."""
+    global conversation_tokens
+    conversation_history.append(msg)
+    conversation_tokens += message_tokens(msg)
+
+def forget_context_messages(messages: List[Dict[str, Any]]) -> None:
+    """Drop the files_in_context and context_sources entries that point to 'messages'."""
+    message_ids = {id(msg) for msg in messages}
+    for tracked in (files_in_context, context_sources):
+        for path in [path for path, msg in tracked.items() if id(msg) in message_ids]:
+            del tracked[path]
+
+def add_context_message(source_path: str, content: str, pinned: bool = True) -> Dict[str, Any]:
+    """Add a system message with the content of 'source_path'.
+
+    A pinned message goes at the end of the pinned prefix, ahead of the
+    conversation turns, so it is never trimmed. An unpinned one goes right
+    after the current turn's user message and is trimmed along with that turn.
+    If the same file or directory was added before, its message is updated in
+    place instead, and an unpinned message is moved into the prefix when it
+    is added again pinned.
+    """
+    global conversation_tokens, pinned_prefix_len, pinned_tokens
+    message = context_sources.get(source_path)
+    if message is not None and pinned and not any(msg is message for msg in conversation_history[:pinned_prefix_len]):
+        # Replace the trimmable copy with a pinned one
+        conversation_history.remove(message)
+        conversation_tokens -= message_tokens(message)
+        forget_context_messages([message])
+        message = None
+    if message is None:
+        message = {"role": "system", "content": content}
+        if pinned:
+            conversation_history.insert(pinned_prefix_len, message)
+            pinned_prefix_len += 1
+            pinned_tokens += message_tokens(message)
+        else:
+            turn_start = len(conversation_history)
+            while turn_start > pinned_prefix_len and conversation_history[turn_start - 1]["role"] != "user":
+                turn_start -= 1
+            if turn_start == pinned_prefix_len:
+                turn_start = len(conversation_history)  # No turn yet
+            conversation_history.insert(turn_start, message)
+        conversation_tokens += message_tokens(message)
+        context_sources[source_path] = message
+    elif message["content"] != content:
+        # Files listed under the old content are re-registered by the caller
+        for path in [path for path, msg in files_in_context.items() if msg is message]:
+            del files_in_context[path]
+        old_tokens = message_tokens(message)
+        message["content"] = content
+        message.pop("_tokens", None)
+        conversation_tokens += message_tokens(message) - old_tokens
+        if any(msg is message for msg in conversation_history[:pinned_prefix_len]):
+            pinned_tokens += message_tokens(message) - old_tokens
+    return message
+
+def api_messages(messages: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """Return the messages (the whole conversation by default) without local '_'-prefixed bookkeeping keys, ready for the API."""
+    if messages is None:
+        messages = conversation_history
+    return [{key: value for key, value in msg.items() if not key.startswith("_")} for msg in messages]
+
+def get_conversation_tokens() -> int:
+    """Return total tokens in current conversation."""
+    return conversation_tokens
+
 def check_token_limit(additional_tokens: int) -> Tuple[bool, int]:
     """Check if adding tokens would exceed limit. Returns (can_add, current_total)."""
     current = get_conversation_tokens()
@@ -253,12 +378,18 @@ def check_token_limit(additional_tokens: int) -> Tuple[bool, int]:
         return False, current
     return True, current
 
-def truncate_content(content: str, max_tokens: int) -> str:
-    """Truncate content to fit within token limit."""
-    estimated_tokens = estimate_tokens(content)
+def truncate_content(content: str, max_tokens: int, content_tokens: Optional[int] = None) -> str:
+    """Truncate content to fit within token limit. Pass 'content_tokens' if already known."""
+    estimated_tokens = content_tokens if content_tokens is not None else estimate_tokens(content)
     if estimated_tokens <= max_tokens:
         return content
     
+    encoder = get_encoder()
+    if encoder is not None:
+        # Cut at the exact token boundary
+        token_ids = encoder.encode(content, disallowed_special=())
+        return encoder.decode(token_ids[:max_tokens]) + "\n\n... [Content truncated due to token limit]"
+    
     # Calculate approximate character limit
     char_limit = max_tokens * CHARS_PER_TOKEN
     truncated = content[:char_limit]
@@ -275,6 +406,38 @@ def read_local_file(file_path: str) -> str:
     with open(file_path, "r", encoding="utf-8") as f:
         return f.read()
 
+def read_text_or_none(file_path: str, peek_size: int = 4096) -> Optional[str]:
+    """Return the text content of a local file, or None if it looks binary."""
+    with open(file_path, "rb") as f:
+        head = f.read(peek_size)
+        # If there is a null byte in the sample, treat it as binary
+        if b'\0' in head:
+            return None
+        rest = f.read()
+    # Translate newlines like text mode does, so the content matches read_local_file()
+    return (head + rest).decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+
+def map_in_threads(func, items: List[Any]) -> List[Any]:
+    """Apply 'func' to every item on a small thread pool, preserving order."""
+    if len(items) <= 1:
+        # Not worth spinning up a pool for a single item
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(MAX_IO_WORKERS, len(items))) as executor:
+        return list(executor.map(func, items))
+
+def read_tool_file(file_path: str) -> str:
+    """Read a file for a tool call, returning its content or an error message."""
+    try:
+        normalized_path = normalize_path(file_path)
+        content = read_local_file(normalized_path)
+        return f"Content of file '{normalized_path}':\n\n{content}"
+    except (OSError, ValueError) as e:
+        return f"Error reading '{file_path}': {e}"
+
+def read_files_batch(file_paths: List[str]) -> List[str]:
+    """Read several files concurrently, returning one result per path in order."""
+    return map_in_threads(read_tool_file, file_paths)
+
 def create_file(path: str, content: str):
     """Create (or overwrite) a file at 'path' with the given 'content'."""
     file_path = Path(path)
@@ -288,15 +451,22 @@ def create_file(path: str, content: str):
     if len(content) > 5_000_000:  # 5MB limit
         raise ValueError("File content exceeds 5MB size limit")
     
+    # Encode once and write bytes, translating newlines like text mode would
+    if os.linesep != "\n":
+        content = content.replace("\n", os.linesep)
+    data = content.encode("utf-8")
+    
     file_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(content)
+    with open(file_path, "wb") as f:
+        f.write(data)
     console.print(f"[bold blue]✓[/bold blue] Created/updated file at '[bright_cyan]{file_path}[/bright_cyan]'")
 
 def show_diff_table(files_to_edit: List[FileToEdit]) -> None:
     if not files_to_edit:
         return
     
+    from rich.table import Table  # Only needed here, keep it off the startup path
+    
     table = Table(title="📝 Proposed Edits", show_header=True, header_style="bold bright_blue", show_lines=True, border_style="blue")
     table.add_column("File Path", style="bright_cyan", no_wrap=True)
     table.add_column("Original", style="red dim")
@@ -313,15 +483,15 @@ def apply_diff_edit(path: str, original_snippet: str, new_snippet: str):
         content = read_local_file(path)
         
         # Verify we're replacing the exact intended occurrence
-        occurrences = content.count(original_snippet)
-        if occurrences == 0:
+        start = content.find(original_snippet)
+        if start < 0:
             raise ValueError("Original snippet not found")
-        if occurrences > 1:
-            console.print(f"[bold yellow]⚠ Multiple matches ({occurrences}) found - requiring line numbers for safety[/bold yellow]")
+        if content.find(original_snippet, start + 1) >= 0:
+            console.print("[bold yellow]⚠ Multiple matches found - requiring line numbers for safety[/bold yellow]")
             console.print("[dim]Use format:\n--- original.py (lines X-Y)\n+++ modified.py[/dim]")
-            raise ValueError(f"Ambiguous edit: {occurrences} matches")
+            raise ValueError("Ambiguous edit: multiple matches")
         
-        updated_content = content.replace(original_snippet, new_snippet, 1)
+        updated_content = content[:start] + new_snippet + content[start + len(original_snippet):]
         create_file(path, updated_content)
         console.print(f"[bold blue]✓[/bold blue] Applied diff edit to '[bright_cyan]{path}[/bright_cyan]'")
 
@@ -336,7 +506,7 @@ def apply_diff_edit(path: str, original_snippet: str, new_snippet: str):
 
 def try_handle_add_command(user_input: str) -> bool:
     prefix = "/add "
-    if user_input.strip().lower().startswith(prefix):
+    if user_input[:len(prefix)].lower() == prefix:
         path_to_add = user_input[len(prefix):].strip()
         try:
             normalized_path = normalize_path(path_to_add)
@@ -358,100 +528,154 @@ def try_handle_add_command(user_input: str) -> bool:
                 # Truncate if needed
                 if file_tokens > MAX_FILE_TOKENS:
                     console.print(f"[yellow]⚠ File is large ({file_tokens:,} tokens). Truncating to {MAX_FILE_TOKENS:,} tokens.[/yellow]")
-                    content = truncate_content(content, MAX_FILE_TOKENS)
+                    content = truncate_content(content, MAX_FILE_TOKENS, file_tokens)
+                    file_tokens = estimate_tokens(content)
                 
-                conversation_history.append({
-                    "role": "system",
-                    "content": f"Content of file '{normalized_path}':\n\n{content}"
-                })
+                files_in_context[normalized_path] = add_context_message(
+                    normalized_path, f"Content of file '{normalized_path}':\n\n{content}"
+                )
                 console.print(f"[bold blue]✓[/bold blue] Added file '[bright_cyan]{normalized_path}[/bright_cyan]' to conversation.")
-                console.print(f"[dim]Tokens used: {estimate_tokens(content):,} (Total: {get_conversation_tokens():,} / {MAX_CONTEXT_TOKENS:,})[/dim]\n")
+                console.print(f"[dim]Tokens used: {file_tokens:,} (Total: {get_conversation_tokens():,} / {MAX_CONTEXT_TOKENS:,})[/dim]\n")
         except OSError as e:
             console.print(f"[bold red]✗[/bold red] Could not add path '[bright_cyan]{path_to_add}[/bright_cyan]': {e}\n")
         return True
     return False
 
+# Files, directories and extensions skipped when adding a directory
+EXCLUDED_FILES = frozenset({
+    # Python specific
+    ".DS_Store", "Thumbs.db", ".gitignore", ".python-version",
+    "uv.lock", ".uv", "uvenv", ".uvenv", ".venv", "venv",
+    "__pycache__", ".pytest_cache", ".coverage", ".mypy_cache",
+    # Node.js / Web specific
+    "node_modules", "package-lock.json", "yarn.lock", "pnpm-lock.yaml",
+    ".next", ".nuxt", "dist", "build", ".cache", ".parcel-cache",
+    ".turbo", ".vercel", ".output", ".contentlayer",
+    # Build outputs
+    "out", "coverage", ".nyc_output", "storybook-static",
+    # Environment and config
+    ".env", ".env.local", ".env.development", ".env.production",
+    # Misc
+    ".git", ".svn", ".hg", "CVS"
+})
+EXCLUDED_EXTENSIONS = frozenset({
+    # Binary and media files
+    ".png", ".jpg", ".jpeg", ".gif", ".ico", ".svg", ".webp", ".avif",
+    ".mp4", ".webm", ".mov", ".mp3", ".wav", ".ogg",
+    ".zip", ".tar", ".gz", ".7z", ".rar",
+    ".exe", ".dll", ".so", ".dylib", ".bin",
+    # Documents
+    ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+    # Python specific
+    ".pyc", ".pyo", ".pyd", ".egg", ".whl",
+    # UV specific
+    ".uv", ".uvenv",
+    # Database and logs
+    ".db", ".sqlite", ".sqlite3", ".log",
+    # IDE specific
+    ".idea", ".vscode",
+    # Web specific
+    ".map", ".chunk.js", ".chunk.css",
+    ".min.js", ".min.css", ".bundle.js", ".bundle.css",
+    # Cache and temp files
+    ".cache", ".tmp", ".temp",
+    # Font files
+    ".ttf", ".otf", ".woff", ".woff2", ".eot"
+})
+
+def _alternation(words) -> str:
+    # Longest first so compound extensions like '.min.js' are tried before '.js'
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+# One pattern for hidden files, excluded file names and excluded extensions.
+# Extensions match at the end of the name, so compound ones like '.min.js' apply too
+EXCLUDED_FILE_RE = re.compile(
+    r"^\.|^(?:" + _alternation(EXCLUDED_FILES) + r")$"
+    r"|(?i:" + _alternation(EXCLUDED_EXTENSIONS) + r")$"
+)
+
+def scan_directory(directory_path: str):
+    """Recursively yield non-directory entries under 'directory_path', skipping hidden and excluded directories.
+
+    Broken symlinks and other non-regular entries are yielded too, so the
+    caller can report them as skipped.
+    """
+    try:
+        with os.scandir(directory_path) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not entry.name.startswith('.') and entry.name not in EXCLUDED_FILES:
+                subdirs.append(entry.path)
+        else:
+            yield entry
+
+    # Visit files before subdirectories, like os.walk
+    for subdir in subdirs:
+        yield from scan_directory(subdir)
+
 def add_directory_to_conversation(directory_path: str):
     """Add directory contents with improved token management."""
     with console.status("[bold bright_blue]🔍 Scanning directory...[/bold bright_blue]") as status:
-        excluded_files = {
-            # Python specific
-            ".DS_Store", "Thumbs.db", ".gitignore", ".python-version",
-            "uv.lock", ".uv", "uvenv", ".uvenv", ".venv", "venv",
-            "__pycache__", ".pytest_cache", ".coverage", ".mypy_cache",
-            # Node.js / Web specific
-            "node_modules", "package-lock.json", "yarn.lock", "pnpm-lock.yaml",
-            ".next", ".nuxt", "dist", "build", ".cache", ".parcel-cache",
-            ".turbo", ".vercel", ".output", ".contentlayer",
-            # Build outputs
-            "out", "coverage", ".nyc_output", "storybook-static",
-            # Environment and config
-            ".env", ".env.local", ".env.development", ".env.production",
-            # Misc
-            ".git", ".svn", ".hg", "CVS"
-        }
-        excluded_extensions = {
-            # Binary and media files
-            ".png", ".jpg", ".jpeg", ".gif", ".ico", ".svg", ".webp", ".avif",
-            ".mp4", ".webm", ".mov", ".mp3", ".wav", ".ogg",
-            ".zip", ".tar", ".gz", ".7z", ".rar",
-            ".exe", ".dll", ".so", ".dylib", ".bin",
-            # Documents
-            ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
-            # Python specific
-            ".pyc", ".pyo", ".pyd", ".egg", ".whl",
-            # UV specific
-            ".uv", ".uvenv",
-            # Database and logs
-            ".db", ".sqlite", ".sqlite3", ".log",
-            # IDE specific
-            ".idea", ".vscode",
-            # Web specific
-            ".map", ".chunk.js", ".chunk.css",
-            ".min.js", ".min.css", ".bundle.js", ".bundle.css",
-            # Cache and temp files
-            ".cache", ".tmp", ".temp",
-            # Font files
-            ".ttf", ".otf", ".woff", ".woff2", ".eot"
-        }
-        
         # Collect eligible files first
         eligible_files = []
         skipped_files = []
         max_file_size = 500_000  # 500KB limit per file for directories
         
-        for root, dirs, files in os.walk(directory_path):
-            # Skip hidden directories and excluded directories
-            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in excluded_files]
+        for entry in scan_directory(directory_path):
+            file = entry.name
+            full_path = entry.path
+
+            if EXCLUDED_FILE_RE.search(file):
+                skipped_files.append(full_path)
+                continue
             
-            for file in files:
-                if file.startswith('.') or file in excluded_files:
-                    skipped_files.append(os.path.join(root, file))
+            try:
+                # Check file size (cached by scandir on most platforms)
+                file_size = entry.stat().st_size
+                if not entry.is_file():
+                    skipped_files.append(f"{full_path} (not a regular file)")
                     continue
-                
-                _, ext = os.path.splitext(file)
-                if ext.lower() in excluded_extensions:
-                    skipped_files.append(os.path.join(root, file))
+                if file_size > max_file_size:
+                    skipped_files.append(f"{full_path} (too large: {file_size:,} bytes)")
                     continue
                 
-                full_path = os.path.join(root, file)
+                eligible_files.append(full_path)
                 
-                try:
-                    # Check file size
-                    file_size = os.path.getsize(full_path)
-                    if file_size > max_file_size:
-                        skipped_files.append(f"{full_path} (too large: {file_size:,} bytes)")
-                        continue
-                    
-                    # Check if it's binary
-                    if is_binary_file(full_path):
-                        skipped_files.append(f"{full_path} (binary)")
-                        continue
-                    
-                    eligible_files.append(full_path)
-                    
-                except OSError:
-                    skipped_files.append(f"{full_path} (error reading)")
+            except OSError:
+                skipped_files.append(f"{full_path} (error reading)")
+        
+        def read_candidate(file_path: str) -> Tuple[str, Optional[str], Optional[Exception]]:
+            try:
+                normalized_path = normalize_path(file_path)
+                return normalized_path, read_text_or_none(normalized_path), None
+            except Exception as e:
+                return file_path, None, e
+        
+        # Read candidates concurrently, in batches, until enough of them turn
+        # out to be text. Binary files are only detected once opened and must
+        # not count against MAX_FILES_PER_ADD.
+        files_to_add = []
+        read_results = []
+        binary_count = 0
+        next_candidate = 0
+        while len(files_to_add) < MAX_FILES_PER_ADD and next_candidate < len(eligible_files):
+            batch = eligible_files[next_candidate:next_candidate + MAX_FILES_PER_ADD - len(files_to_add)]
+            next_candidate += len(batch)
+            for file_path, result in zip(batch, map_in_threads(read_candidate, batch)):
+                _, content, error = result
+                if content is None and error is None:
+                    skipped_files.append(f"{file_path} (binary)")
+                    binary_count += 1
+                else:
+                    files_to_add.append(file_path)
+                    read_results.append(result)
+        # Candidates left unread are counted as eligible
+        eligible_count = len(eligible_files) - binary_count
         
         # Now process eligible files with token limits
         added_files = []
@@ -461,21 +685,26 @@ def add_directory_to_conversation(directory_path: str):
         console.print(f"\n[bold yellow]⚠ Token Budget:[/bold yellow]")
         console.print(f"Current usage: {current_tokens:,} / {MAX_CONTEXT_TOKENS:,} tokens")
         console.print(f"Available: {MAX_CONTEXT_TOKENS - current_tokens:,} tokens")
-        console.print(f"Found {len(eligible_files)} eligible files\n")
+        console.print(f"Found {eligible_count} eligible files\n")
+        
+        if eligible_count > MAX_FILES_PER_ADD:
+            console.print(f"[yellow]⚠ Limiting to first {MAX_FILES_PER_ADD} files (found {eligible_count})[/yellow]\n")
         
-        # Limit files to add
-        files_to_add = eligible_files[:MAX_FILES_PER_ADD]
-        if len(eligible_files) > MAX_FILES_PER_ADD:
-            console.print(f"[yellow]⚠ Limiting to first {MAX_FILES_PER_ADD} files (found {len(eligible_files)})[/yellow]\n")
+        # Collect file contents into a single buffer
+        files_content = io.StringIO()
+        files_content.write(f"Files from directory '{directory_path}':")
+        added_paths = []
         
-        # Collect file contents
-        files_content = []
+        # Tokenize concurrently, then apply the token budget in order
+        token_counts = iter(estimate_tokens_batch([content for _, content, _ in read_results if content is not None]))
         
-        for file_path in files_to_add:
+        for file_path, (normalized_path, content, error) in zip(files_to_add, read_results):
+            if error is not None:
+                console.print(f"[red]Error reading {file_path}: {error}[/red]")
+                continue
+            
             try:
-                normalized_path = normalize_path(file_path)
-                content = read_local_file(normalized_path)
-                file_tokens = estimate_tokens(content)
+                file_tokens = next(token_counts)
                 
                 # Check if we can add this file
                 if current_tokens + total_tokens_added + file_tokens > MAX_CONTEXT_TOKENS:
@@ -484,67 +713,58 @@ def add_directory_to_conversation(directory_path: str):
                 
                 # Truncate if individual file is too large
                 if file_tokens > MAX_FILE_TOKENS // 2:  # Use half limit for directory adds
-                    content = truncate_content(content, MAX_FILE_TOKENS // 2)
+                    content = truncate_content(content, MAX_FILE_TOKENS // 2, file_tokens)
                     file_tokens = estimate_tokens(content)
                 
                 relative_path = os.path.relpath(normalized_path, directory_path)
-                files_content.append(f"=== {relative_path} ===\n{content}")
+                files_content.write(f"\n\n=== {relative_path} ===\n")
+                files_content.write(content)
                 added_files.append(relative_path)
+                added_paths.append(normalized_path)
                 total_tokens_added += file_tokens
                 
             except Exception as e:
                 console.print(f"[red]Error reading {file_path}: {e}[/red]")
         
-        if files_content:
+        if added_files:
             # Add all files in a single consolidated message
-            consolidated_content = f"Files from directory '{directory_path}':\n\n" + "\n\n".join(files_content)
-            conversation_history.append({
-                "role": "system",
-                "content": consolidated_content
-            })
+            directory_message = add_context_message(directory_path, files_content.getvalue())
+            for normalized_path in added_paths:
+                files_in_context[normalized_path] = directory_message
             
             console.print(f"[bold blue]✓[/bold blue] Added {len(added_files)} files from '[bright_cyan]{directory_path}[/bright_cyan]'")
             console.print(f"[dim]Tokens added: {total_tokens_added:,} (Total: {get_conversation_tokens():,} / {MAX_CONTEXT_TOKENS:,})[/dim]\n")
             
-            if added_files:
-                console.print("[bold bright_blue]📁 Added files:[/bold bright_blue]")
-                for f in added_files[:10]:  # Show first 10
-                    console.print(f"  [bright_cyan]📄 {f}[/bright_cyan]")
-                if len(added_files) > 10:
-                    console.print(f"  [dim]... and {len(added_files) - 10} more[/dim]")
+            console.print("[bold bright_blue]📁 Added files:[/bold bright_blue]")
+            for f in added_files[:10]:  # Show first 10
+                console.print(f"  [bright_cyan]📄 {f}[/bright_cyan]")
+            if len(added_files) > 10:
+                console.print(f"  [dim]... and {len(added_files) - 10} more[/dim]")
         else:
             console.print(f"[yellow]⚠ No files could be added from '{directory_path}' due to token limits[/yellow]")
         
         if skipped_files and len(skipped_files) < 20:
             console.print(f"\n[dim]Skipped {len(skipped_files)} files (binary/excluded/large)[/dim]")
 
-def is_binary_file(file_path: str, peek_size: int = 1024) -> bool:
-    try:
-        with open(file_path, 'rb') as f:
-            chunk = f.read(peek_size)
-        # If there is a null byte in the sample, treat it as binary
-        if b'\0' in chunk:
-            return True
-        return False
-    except Exception:
-        # If we fail to read, just treat it as binary to be safe
-        return True
-
 def ensure_file_in_context(file_path: str) -> bool:
     try:
         normalized_path = normalize_path(file_path)
+        if normalized_path in files_in_context:
+            return True
         content = read_local_file(normalized_path)
-        file_marker = f"Content of file '{normalized_path}'"
-        if not any(file_marker in msg["content"] for msg in conversation_history):
-            conversation_history.append({
-                "role": "system",
-                "content": f"{file_marker}:\n\n{content}"
-            })
+        file_tokens = estimate_tokens(content)
+        if file_tokens > MAX_FILE_TOKENS:
+            content = truncate_content(content, MAX_FILE_TOKENS, file_tokens)
+        # Edit context belongs to the current turn, so it is not pinned
+        files_in_context[normalized_path] = add_context_message(
+            normalized_path, f"Content of file '{normalized_path}':\n\n{content}", pinned=False
+        )
         return True
     except OSError:
         console.print(f"[bold red]✗[/bold red] Could not read file '[bright_cyan]{file_path}[/bright_cyan]' for editing context")
         return False
 
+@lru_cache(maxsize=4096)  # Paths repeat a lot within a session, skip the realpath syscalls
 def normalize_path(path_str: str) -> str:
     """Return a canonical, absolute version of the path with security checks."""
     path = Path(path_str).resolve()
@@ -555,345 +775,516 @@ def normalize_path(path_str: str) -> str:
     
     return str(path)
 
+@lru_cache(maxsize=1)
+def get_prompt_session():
+    """Create the prompt_toolkit session on first use. Returns None if it is unavailable."""
+    # Try to initialize prompt session with fallback
+    try:
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.styles import Style as PromptStyle
+        
+        return PromptSession(
+            style=PromptStyle.from_dict({
+                'prompt': '#0066ff bold',  # Bright blue prompt
+                'completion-menu.completion': 'bg:#1e3a8a fg:#ffffff',
+                'completion-menu.completion.current': 'bg:#3b82f6 fg:#ffffff bold',
+            })
+        )
+    except Exception:
+        # Fallback for environments without proper console
+        console.print("[yellow]Note: Running in fallback mode (no auto-completion)[/yellow]")
+        return None
+
 # Fallback input function for environments without prompt_toolkit
 def get_user_input(prompt_text: str) -> str:
     """Get user input with fallback for environments without prompt_toolkit."""
-    if use_prompt_toolkit and prompt_session:
+    prompt_session = get_prompt_session()
+    if prompt_session:
         return prompt_session.prompt(prompt_text)
     else:
         # Fallback to standard input
         return input(prompt_text)
 
+class StreamWriter:
+    """Buffer streamed text and write it to the terminal in batches.
+
+    Writing raw text to the console file skips Rich's per-call rendering,
+    which also keeps brackets in model output from being read as markup.
+    Call flush() before printing anything else through the console.
+    """
+
+    def __init__(self, max_chars: int = 64, max_delay: float = 0.016):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.parts: List[str] = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, text: str) -> None:
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.max_chars or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.parts:
+            console.file.write("".join(self.parts))
+            console.file.flush()
+            self.parts.clear()
+            self.size = 0
+        self.last_flush = time.monotonic()
+
 # --------------------------------------------------------------------------------
 # 5. Conversation state
 # --------------------------------------------------------------------------------
+# The history starts with a pinned prefix: the system prompt at index 0
+# followed by the content of added files. Conversation turns come after it and
+# only they are ever trimmed, so every request starts with the same prefix and
+# DeepSeek's context cache can reuse it.
+SYSTEM_PROMPT_TOKENS = estimate_tokens(system_PROMPT)
 conversation_history = [
-    {"role": "system", "content": system_PROMPT}
+    {"role": "system", "content": system_PROMPT, "_tokens": SYSTEM_PROMPT_TOKENS}
 ]
+pinned_prefix_len = len(conversation_history)  # Messages before the first conversation turn
+conversation_tokens = SYSTEM_PROMPT_TOKENS  # Kept in sync by append_message()
+pinned_tokens = SYSTEM_PROMPT_TOKENS  # Part of conversation_tokens in the pinned prefix
+current_turn = 0  # Number of user messages sent so far
+local_call_ids = itertools.count()  # Ids for tool calls streamed without one
+files_in_context: Dict[str, Dict[str, Any]] = {}  # Normalized path -> message holding its content
+context_sources: Dict[str, Dict[str, Any]] = {}  # Path given to /add or an edit -> message it created
 
 # --------------------------------------------------------------------------------
 # 6. OpenAI API interaction with streaming
 # --------------------------------------------------------------------------------
 
-def execute_function_call_dict(tool_call_dict) -> str:
-    """Execute a function call from a dictionary format and return the result as a string."""
+def handle_read_file(arguments: Dict[str, Any]) -> str:
+    file_path = arguments["file_path"]
+    normalized_path = normalize_path(file_path)
+    content = read_local_file(normalized_path)
+    return f"Content of file '{normalized_path}':\n\n{content}"
+
+def handle_read_multiple_files(arguments: Dict[str, Any]) -> str:
+    file_paths = arguments["file_paths"]
+    results = read_files_batch(file_paths)
+    return "\n\n" + "="*50 + "\n\n".join(results)
+
+def handle_create_file(arguments: Dict[str, Any]) -> str:
+    file_path = arguments["file_path"]
+    content = arguments["content"]
+    create_file(file_path, content)
+    return f"Successfully created file '{file_path}'"
+
+def handle_create_multiple_files(arguments: Dict[str, Any]) -> str:
+    files = arguments["files"]
+    created_files = [file_info["path"] for file_info in files]
+
+    def write_file(file_info: Dict[str, str]) -> None:
+        create_file(file_info["path"], file_info["content"])
+
+    if len({normalize_path(path) for path in created_files}) == len(files):
+        # Distinct targets, write them concurrently
+        map_in_threads(write_file, files)
+    else:
+        # Repeated targets must be written in order so the last one wins
+        for file_info in files:
+            write_file(file_info)
+    return f"Successfully created {len(created_files)} files: {', '.join(created_files)}"
+
+def handle_edit_file(arguments: Dict[str, Any]) -> str:
+    file_path = arguments["file_path"]
+    original_snippet = arguments["original_snippet"]
+    new_snippet = arguments["new_snippet"]
+    
+    # Ensure file is in context first
+    if not ensure_file_in_context(file_path):
+        return f"Error: Could not read file '{file_path}' for editing"
+    
+    apply_diff_edit(file_path, original_snippet, new_snippet)
+    return f"Successfully edited file '{file_path}'"
+
+# Tool name -> handler taking the decoded arguments
+TOOL_HANDLERS = {
+    "read_file": handle_read_file,
+    "read_multiple_files": handle_read_multiple_files,
+    "create_file": handle_create_file,
+    "create_multiple_files": handle_create_multiple_files,
+    "edit_file": handle_edit_file,
+}
+
+def execute_tool(function_name: str, arguments_json: str) -> str:
+    """Execute the named tool with JSON-encoded arguments and return the result as a string."""
     try:
-        function_name = tool_call_dict["function"]["name"]
-        arguments = json.loads(tool_call_dict["function"]["arguments"])
-        
-        if function_name == "read_file":
-            file_path = arguments["file_path"]
-            normalized_path = normalize_path(file_path)
-            content = read_local_file(normalized_path)
-            return f"Content of file '{normalized_path}':\n\n{content}"
-            
-        elif function_name == "read_multiple_files":
-            file_paths = arguments["file_paths"]
-            results = []
-            for file_path in file_paths:
-                try:
-                    normalized_path = normalize_path(file_path)
-                    content = read_local_file(normalized_path)
-                    results.append(f"Content of file '{normalized_path}':\n\n{content}")
-                except OSError as e:
-                    results.append(f"Error reading '{file_path}': {e}")
-            return "\n\n" + "="*50 + "\n\n".join(results)
-            
-        elif function_name == "create_file":
-            file_path = arguments["file_path"]
-            content = arguments["content"]
-            create_file(file_path, content)
-            return f"Successfully created file '{file_path}'"
-            
-        elif function_name == "create_multiple_files":
-            files = arguments["files"]
-            created_files = []
-            for file_info in files:
-                create_file(file_info["path"], file_info["content"])
-                created_files.append(file_info["path"])
-            return f"Successfully created {len(created_files)} files: {', '.join(created_files)}"
-            
-        elif function_name == "edit_file":
-            file_path = arguments["file_path"]
-            original_snippet = arguments["original_snippet"]
-            new_snippet = arguments["new_snippet"]
-            
-            # Ensure file is in context first
-            if not ensure_file_in_context(file_path):
-                return f"Error: Could not read file '{file_path}' for editing"
-            
-            apply_diff_edit(file_path, original_snippet, new_snippet)
-            return f"Successfully edited file '{file_path}'"
-            
-        else:
+        arguments = json_loads(arguments_json)
+        handler = TOOL_HANDLERS.get(function_name)
+        if handler is None:
             return f"Unknown function: {function_name}"
-            
+        return handler(arguments)
     except Exception as e:
         return f"Error executing {function_name}: {str(e)}"
 
+def execute_function_call_dict(tool_call_dict) -> str:
+    """Execute a function call from a dictionary format and return the result as a string."""
+    return execute_tool(tool_call_dict["function"]["name"], tool_call_dict["function"]["arguments"])
+
 def execute_function_call(tool_call) -> str:
     """Execute a function call and return the result as a string."""
-    try:
-        function_name = tool_call.function.name
-        arguments = json.loads(tool_call.function.arguments)
-        
-        if function_name == "read_file":
-            file_path = arguments["file_path"]
-            normalized_path = normalize_path(file_path)
-            content = read_local_file(normalized_path)
-            return f"Content of file '{normalized_path}':\n\n{content}"
-            
-        elif function_name == "read_multiple_files":
-            file_paths = arguments["file_paths"]
-            results = []
-            for file_path in file_paths:
-                try:
-                    normalized_path = normalize_path(file_path)
-                    content = read_local_file(normalized_path)
-                    results.append(f"Content of file '{normalized_path}':\n\n{content}")
-                except OSError as e:
-                    results.append(f"Error reading '{file_path}': {e}")
-            return "\n\n" + "="*50 + "\n\n".join(results)
-            
-        elif function_name == "create_file":
-            file_path = arguments["file_path"]
-            content = arguments["content"]
-            create_file(file_path, content)
-            return f"Successfully created file '{file_path}'"
-            
-        elif function_name == "create_multiple_files":
-            files = arguments["files"]
-            created_files = []
-            for file_info in files:
-                create_file(file_info["path"], file_info["content"])
-                created_files.append(file_info["path"])
-            return f"Successfully created {len(created_files)} files: {', '.join(created_files)}"
-            
-        elif function_name == "edit_file":
-            file_path = arguments["file_path"]
-            original_snippet = arguments["original_snippet"]
-            new_snippet = arguments["new_snippet"]
-            
-            # Ensure file is in context first
-            if not ensure_file_in_context(file_path):
-                return f"Error: Could not read file '{file_path}' for editing"
-            
-            apply_diff_edit(file_path, original_snippet, new_snippet)
-            return f"Successfully edited file '{file_path}'"
-            
-        else:
-            return f"Unknown function: {function_name}"
-            
-    except Exception as e:
-        return f"Error executing {function_name}: {str(e)}"
+    return execute_tool(tool_call.function.name, tool_call.function.arguments)
+
+# Tools that only read files and can safely run alongside each other
+READ_ONLY_TOOLS = frozenset({"read_file", "read_multiple_files"})
+
+def prefetch_read_only_calls(tool_calls: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Run the read-only tool calls ahead of the first write concurrently.
+
+    Returns results keyed by tool call id. Calls after the first write may
+    depend on it and are left to the regular, in-order dispatcher.
+    """
+    read_calls = []
+    for tool_call in tool_calls:
+        if tool_call["function"]["name"] not in READ_ONLY_TOOLS:
+            break
+        read_calls.append(tool_call)
+
+    if len(read_calls) < 2:
+        return {}
+    results = map_in_threads(execute_function_call_dict, read_calls)
+    return {tool_call["id"]: result for tool_call, result in zip(read_calls, results)}
+
+def shorten_text(text: str, max_chars: int = SUMMARY_EXCERPT_CHARS) -> str:
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... [{len(text) - max_chars:,} more chars]"
+
+def summary_transcript(messages: List[Dict[str, Any]]) -> str:
+    """Serialize messages for summarization, keeping every message represented.
+
+    File contents, tool results and tool call arguments are cut to short
+    excerpts first. If the transcript is still over MAX_SUMMARY_INPUT_TOKENS,
+    each message gets an equal share of the budget instead of the newest
+    ones being dropped.
+    """
+    entries = api_messages(messages)
+    for entry in entries:
+        content = entry.get("content") or ""
+        if entry["role"] == "tool" or content.startswith("Content of file '"):
+            entry["content"] = shorten_text(content)
+        if entry.get("tool_calls"):
+            # Copy the nested dicts, they are shared with the conversation
+            entry["tool_calls"] = [
+                {**tool_call, "function": {**tool_call["function"], "arguments": shorten_text(tool_call["function"]["arguments"])}}
+                for tool_call in entry["tool_calls"]
+            ]
+    transcript = json_dumps(entries)
+    if estimate_tokens(transcript) > MAX_SUMMARY_INPUT_TOKENS:
+        # Whatever the contents leave over (roles, tool calls) is taken off the budget first
+        overhead = estimate_tokens(json_dumps([{**entry, "content": ""} for entry in entries]))
+        share = max((MAX_SUMMARY_INPUT_TOKENS - overhead) // len(entries), 1)
+        for entry in entries:
+            if entry.get("content"):
+                entry["content"] = truncate_content(entry["content"], share)
+        transcript = json_dumps(entries)
+    return transcript
+
+def summarize_transcript(transcript: str) -> str:
+    """Summarize a JSON transcript of old messages with the cheaper chat model."""
+    response = client.chat.completions.create(
+        model="deepseek-chat",
+        messages=[{
+            "role": "user",
+            "content": "Summarize this earlier part of a coding session. Keep file paths, "
+                       "decisions and open tasks; skip file contents.\n\n" + transcript
+        }],
+        max_tokens=MAX_SUMMARY_TOKENS
+    )
+    return response.choices[0].message.content or ""
 
-def trim_conversation_history():
-    """Improved trimming that preserves important context."""
-    # Keep more messages and be smarter about what to trim
-    MAX_MESSAGES = 30  # Increased from 15
+def elide_old_tool_results() -> None:
+    """Replace tool results from more than TOOL_RESULT_TURNS turns ago with a one-line note."""
+    global conversation_tokens
+    for msg in conversation_history:
+        turn = msg.get("_turn")
+        if turn is None or current_turn - turn <= TOOL_RESULT_TURNS:
+            continue
+        del msg["_turn"]
+        content = msg["content"]
+        if len(content) <= 200:
+            continue  # Already short
+        # Files read by this call are no longer in context
+        forget_context_messages([msg])
+        conversation_tokens -= message_tokens(msg)
+        msg["content"] = f"<tool result elided: {len(content):,} chars, call the tool again if needed>"
+        msg.pop("_tokens", None)
+        conversation_tokens += message_tokens(msg)
+
+def over_trim_budget(tail_len: int, total_tokens: int) -> bool:
+    """Check whether a tail of 'tail_len' messages and 'total_tokens' in all needs trimming.
+
+    Only the tail counts against COMPACT_AT_TOKENS, since the pinned prefix
+    cannot be trimmed. The whole conversation must still fit MAX_CONTEXT_TOKENS.
+    """
+    return (tail_len > MAX_MESSAGES
+            or total_tokens - pinned_tokens > COMPACT_AT_TOKENS
+            or total_tokens > MAX_CONTEXT_TOKENS)
+
+def trim_conversation_history() -> bool:
+    """Compact the oldest turns after the pinned prefix. Returns True if anything was removed.
+
+    The pinned prefix is never reordered or trimmed. Turns are cut at user
+    messages so no tool result is separated from the call that requested it,
+    and the evicted turns are replaced by a single summary message. If the
+    summary cannot be generated, a short placeholder is used instead.
+    """
+    global conversation_tokens
+    elide_old_tool_results()
+    tail = conversation_history[pinned_prefix_len:]
+    if not over_trim_budget(len(tail), conversation_tokens):
+        return False
     
-    if len(conversation_history) <= MAX_MESSAGES:
-        return
+    # Keep the last N-5 messages, then keep moving the cut forward one turn at
+    # a time while still over the token budget. The latest turn always stays.
+    min_cut = len(tail) - (MAX_MESSAGES - 5) if len(tail) > MAX_MESSAGES else 0
+    cut = 0
+    kept_tokens = conversation_tokens
+    turn_tokens = 0  # Cached tokens of the messages from the cut up to 'index'
+    for index, msg in enumerate(tail):
+        if msg["role"] == "user":
+            kept_tokens -= turn_tokens
+            turn_tokens = 0
+            cut = index
+            if cut >= min_cut and not over_trim_budget(0, kept_tokens):
+                break
+        turn_tokens += message_tokens(msg)
     
-    # Always keep the system prompt
-    system_msgs = [msg for msg in conversation_history if msg["role"] == "system" and msg["content"] == system_PROMPT]
-    other_msgs = [msg for msg in conversation_history if msg not in system_msgs]
+    # A summary from an earlier trim is folded into the new one
+    evicted = tail[:cut]
+    if all("_evicted" in msg for msg in evicted):
+        return False  # Nothing to trim
+    evicted_count = sum(msg.get("_evicted", 1) for msg in evicted)
     
-    # If we have too many messages, intelligent trimming
-    if len(other_msgs) > MAX_MESSAGES:
-        # Keep recent messages
-        recent_msgs = other_msgs[-(MAX_MESSAGES-5):]  # Keep last N-5 messages
-        
-        # Also keep the last few user messages for context
-        user_msgs = [msg for msg in other_msgs if msg["role"] == "user"][-5:]
-        
-        # Combine, removing duplicates while preserving order
-        kept_msgs = []
-        seen = set()
-        for msg in user_msgs + recent_msgs:
-            msg_id = id(msg)  # Use object identity
-            if msg_id not in seen:
-                seen.add(msg_id)
-                kept_msgs.append(msg)
-        
-        # Rebuild conversation history
-        conversation_history.clear()
-        conversation_history.extend(system_msgs + kept_msgs)
+    try:
+        summary = summarize_transcript(summary_transcript(evicted))
+    except Exception as e:
+        console.print(f"[yellow]⚠ Could not summarize trimmed messages: {e}[/yellow]")
+        summary = ""
+    if summary:
+        content = f"<summary>{summary}</summary>"
+    else:
+        content = f"[{evicted_count} earlier messages were removed to stay within the context limit]"
+    compacted = {"role": "system", "content": content, "_evicted": evicted_count}
+    conversation_history[pinned_prefix_len:] = [compacted] + tail[cut:]
+    conversation_tokens = kept_tokens + message_tokens(compacted)
+    # Edit context is trimmed with its turn, forget the files it held
+    forget_context_messages(evicted)
+    
+    console.print(f"[dim]Compacted {evicted_count} earlier messages; {len(conversation_history)} messages in history[/dim]")
+    return True
+
+def stream_reasoning(chunks, output: StreamWriter):
+    """Print the reasoning at the start of a stream.
+
+    Reasoning always arrives before the answer, so this consumes chunks until
+    the first one carrying content or tool calls and returns it, or None if
+    the stream ends first.
+    """
+    for chunk in chunks:
+        delta = chunk.choices[0].delta
+        if delta.content or delta.tool_calls:
+            return chunk  # No reasoning in this response
+        if getattr(delta, "reasoning_content", None):
+            output.flush()
+            console.print("\n[bold blue]💭 Reasoning:[/bold blue]")
+            output.write(delta.reasoning_content)
+            break
+    else:
+        return None
+
+    # The header is out, the rest of the reasoning is streamed as is
+    for chunk in chunks:
+        delta = chunk.choices[0].delta
+        if delta.content or delta.tool_calls:
+            # Tool call arguments can stream for a while, show the reasoning now
+            output.flush()
+            if delta.content:
+                console.print("\n")  # Add spacing after reasoning
+                console.print("\n[bold bright_blue]🤖 Assistant>[/bold bright_blue] ", end="")
+            return chunk
+        reasoning_delta = getattr(delta, "reasoning_content", None)
+        if reasoning_delta:
+            output.write(reasoning_delta)
+    return None
+
+def run_stream(output: StreamWriter, allow_tools: bool = True) -> Tuple[str, List[Dict[str, Any]]]:
+    """Stream one completion for the current conversation, printing it as it arrives.
+
+    Returns the response content and the tool calls it requested. With
+    allow_tools=False the model is told to answer in text only.
+    """
+    extra_options = {} if allow_tools else {"tool_choice": "none"}
+    stream = client.chat.completions.create(
+        messages=api_messages(),
+        **STREAM_OPTIONS,
+        **extra_options
+    )
+
+    final_parts = []
+    tool_calls: Dict[int, Dict[str, Any]] = {}  # Stream index -> partial tool call
+
+    chunks = iter(stream)
+    first_chunk = stream_reasoning(chunks, output)
+    for chunk in itertools.chain((first_chunk,) if first_chunk is not None else (), chunks):
+        delta = chunk.choices[0].delta
+        if delta.content:
+            final_parts.append(delta.content)
+            output.write(delta.content)
+        elif delta.tool_calls:
+            if not tool_calls:
+                # Show the buffered text before the (possibly long) arguments stream in
+                output.flush()
+            # Handle tool calls
+            for tool_call_delta in delta.tool_calls:
+                if tool_call_delta.index is not None:
+                    tool_call = tool_calls.get(tool_call_delta.index)
+                    if tool_call is None:
+                        tool_call = tool_calls[tool_call_delta.index] = {
+                            "id": "",
+                            "type": "function",
+                            "function": {"name": [], "arguments": []}
+                        }
+                    
+                    if tool_call_delta.id:
+                        tool_call["id"] = tool_call_delta.id
+                    if tool_call_delta.function:
+                        if tool_call_delta.function.name:
+                            tool_call["function"]["name"].append(tool_call_delta.function.name)
+                        if tool_call_delta.function.arguments:
+                            tool_call["function"]["arguments"].append(tool_call_delta.function.arguments)
+
+    output.flush()
+    console.print()  # New line after streaming
+
+    # Convert our tool_calls format to the expected format
+    formatted_tool_calls = []
+    for index in sorted(tool_calls):
+        tc = tool_calls[index]
+        # Join the streamed fragments once instead of concatenating per chunk
+        name = "".join(tc["function"]["name"])
+        if name:  # Only add if we have a function name
+            # Ensure we have a valid tool call ID
+            tool_id = tc["id"] or f"call_{next(local_call_ids)}"
+            
+            formatted_tool_calls.append({
+                "id": tool_id,
+                "type": "function",
+                "function": {
+                    "name": name,
+                    "arguments": "".join(tc["function"]["arguments"])
+                }
+            })
+    return "".join(final_parts), formatted_tool_calls
+
+def register_read_result(tool_call: Dict[str, Any], tool_response: Dict[str, Any]) -> None:
+    """Record the files returned by a read tool call, so editing them does not add another copy."""
+    function_name = tool_call["function"]["name"]
+    if function_name not in READ_ONLY_TOOLS:
+        return
+    try:
+        arguments = json_loads(tool_call["function"]["arguments"])
+        file_paths = [arguments["file_path"]] if function_name == "read_file" else arguments["file_paths"]
+        normalized_paths = [normalize_path(file_path) for file_path in file_paths]
+    except (ValueError, KeyError, TypeError):
+        return
+    for normalized_path in normalized_paths:
+        # Failed reads come back as error messages without this header
+        if f"Content of file '{normalized_path}':" in tool_response["content"]:
+            files_in_context[normalized_path] = tool_response
+
+def execute_tool_calls(tool_calls: List[Dict[str, Any]]) -> None:
+    """Execute tool calls in order, adding each result to the conversation."""
+    console.print(f"\n[bold bright_cyan]⚡ Executing {len(tool_calls)} function call(s)...[/bold bright_cyan]")
+    prefetched_results = prefetch_read_only_calls(tool_calls)
+    for tool_call in tool_calls:
+        console.print(f"[bright_blue]→ {tool_call['function']['name']}[/bright_blue]")
         
-        console.print(f"[dim]Trimmed conversation history to {len(conversation_history)} messages[/dim]")
+        try:
+            result = prefetched_results.get(tool_call["id"])
+            if result is None:
+                result = execute_function_call_dict(tool_call)
+            
+            # Add tool result to conversation immediately
+            tool_response = {
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "content": result,
+                "_turn": current_turn
+            }
+            append_message(tool_response)
+            register_read_result(tool_call, tool_response)
+        except Exception as e:
+            console.print(f"[red]Error executing {tool_call['function']['name']}: {e}[/red]")
+            # Still need to add a tool response even on error
+            append_message({
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "content": f"Error: {str(e)}",
+                "_turn": current_turn
+            })
 
 def stream_openai_response(user_message: str):
+    global current_turn
     # Check token limit before sending
-    message_tokens = estimate_tokens(user_message)
+    user_tokens = estimate_tokens(user_message)
     current_tokens = get_conversation_tokens()
+    over_limit = current_tokens + user_tokens > MAX_CONTEXT_TOKENS
     
-    if current_tokens + message_tokens > MAX_CONTEXT_TOKENS:
+    if over_limit:
         console.print(f"\n[bold red]⚠ Token limit approaching![/bold red]")
         console.print(f"Current: {current_tokens:,} tokens")
-        console.print(f"Message: {message_tokens:,} tokens")
-        console.print(f"Total would be: {current_tokens + message_tokens:,} / {MAX_CONTEXT_TOKENS:,}")
+        console.print(f"Message: {user_tokens:,} tokens")
+        console.print(f"Total would be: {current_tokens + user_tokens:,} / {MAX_CONTEXT_TOKENS:,}")
         console.print("\n[yellow]Trimming conversation history...[/yellow]")
-        trim_conversation_history()
-        current_tokens = get_conversation_tokens()
-        console.print(f"[green]After trimming: {current_tokens:,} tokens[/green]\n")
     
-    # Add the user message to conversation history
-    conversation_history.append({"role": "user", "content": user_message})
+    # Add the user message to conversation history, reusing its token count
+    current_turn += 1
+    append_message({"role": "user", "content": user_message, "_tokens": user_tokens})
     
-    # Trim conversation history if it's getting too long
-    trim_conversation_history()
+    # Trim conversation history once, only if it's getting too long
+    if trim_conversation_history() and over_limit:
+        console.print(f"[green]After trimming: {get_conversation_tokens():,} tokens[/green]\n")
 
-    # Remove the old file guessing logic since we'll use function calls
+    output = StreamWriter()
     try:
-        stream = client.chat.completions.create(
-            model="deepseek-reasoner",
-            messages=conversation_history,
-            tools=tools,
-            max_completion_tokens=64000,
-            stream=True
-        )
-
         console.print("\n[bold bright_blue]🐋 Seeking...[/bold bright_blue]")
-        reasoning_started = False
-        reasoning_content = ""
-        final_content = ""
-        tool_calls = []
-
-        for chunk in stream:
-            # Handle reasoning content if available
-            if hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                if not reasoning_started:
-                    console.print("\n[bold blue]💭 Reasoning:[/bold blue]")
-                    reasoning_started = True
-                console.print(chunk.choices[0].delta.reasoning_content, end="")
-                reasoning_content += chunk.choices[0].delta.reasoning_content
-            elif chunk.choices[0].delta.content:
-                if reasoning_started:
-                    console.print("\n")  # Add spacing after reasoning
-                    console.print("\n[bold bright_blue]🤖 Assistant>[/bold bright_blue] ", end="")
-                    reasoning_started = False
-                final_content += chunk.choices[0].delta.content
-                console.print(chunk.choices[0].delta.content, end="")
-            elif chunk.choices[0].delta.tool_calls:
-                # Handle tool calls
-                for tool_call_delta in chunk.choices[0].delta.tool_calls:
-                    if tool_call_delta.index is not None:
-                        # Ensure we have enough tool_calls
-                        while len(tool_calls) <= tool_call_delta.index:
-                            tool_calls.append({
-                                "id": "",
-                                "type": "function",
-                                "function": {"name": "", "arguments": ""}
-                            })
-                        
-                        if tool_call_delta.id:
-                            tool_calls[tool_call_delta.index]["id"] = tool_call_delta.id
-                        if tool_call_delta.function:
-                            if tool_call_delta.function.name:
-                                tool_calls[tool_call_delta.index]["function"]["name"] += tool_call_delta.function.name
-                            if tool_call_delta.function.arguments:
-                                tool_calls[tool_call_delta.index]["function"]["arguments"] += tool_call_delta.function.arguments
-
-        console.print()  # New line after streaming
-
-        # Store the assistant's response in conversation history
-        assistant_message = {
-            "role": "assistant",
-            "content": final_content if final_content else None
-        }
-        
-        if tool_calls:
-            # Convert our tool_calls format to the expected format
-            formatted_tool_calls = []
-            for i, tc in enumerate(tool_calls):
-                if tc["function"]["name"]:  # Only add if we have a function name
-                    # Ensure we have a valid tool call ID
-                    tool_id = tc["id"] if tc["id"] else f"call_{i}_{int(time.time() * 1000)}"
-                    
-                    formatted_tool_calls.append({
-                        "id": tool_id,
-                        "type": "function",
-                        "function": {
-                            "name": tc["function"]["name"],
-                            "arguments": tc["function"]["arguments"]
-                        }
-                    })
-            
-            if formatted_tool_calls:
-                # Important: When there are tool calls, content should be None or empty
-                if not final_content:
-                    assistant_message["content"] = None
-                    
-                assistant_message["tool_calls"] = formatted_tool_calls
-                conversation_history.append(assistant_message)
-                
-                # Execute tool calls and add results immediately
-                console.print(f"\n[bold bright_cyan]⚡ Executing {len(formatted_tool_calls)} function call(s)...[/bold bright_cyan]")
-                for tool_call in formatted_tool_calls:
-                    console.print(f"[bright_blue]→ {tool_call['function']['name']}[/bright_blue]")
-                    
-                    try:
-                        result = execute_function_call_dict(tool_call)
-                        
-                        # Add tool result to conversation immediately
-                        tool_response = {
-                            "role": "tool",
-                            "tool_call_id": tool_call["id"],
-                            "content": result
-                        }
-                        conversation_history.append(tool_response)
-                    except Exception as e:
-                        console.print(f"[red]Error executing {tool_call['function']['name']}: {e}[/red]")
-                        # Still need to add a tool response even on error
-                        conversation_history.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call["id"],
-                            "content": f"Error: {str(e)}"
-                        })
-                
-                # Get follow-up response after tool execution
+        # Keep answering tool calls until the model replies without any. After
+        # MAX_TOOL_ROUNDS rounds, one last request asks for a text-only answer.
+        for round_number in range(MAX_TOOL_ROUNDS + 1):
+            final_round = round_number == MAX_TOOL_ROUNDS
+            if final_round:
+                console.print(f"\n[yellow]⚠ Reached {MAX_TOOL_ROUNDS} rounds of function calls, asking for a final answer[/yellow]")
+            elif round_number:
                 console.print("\n[bold bright_blue]🔄 Processing results...[/bold bright_blue]")
-                
-                follow_up_stream = client.chat.completions.create(
-                    model="deepseek-reasoner",
-                    messages=conversation_history,
-                    tools=tools,
-                    max_completion_tokens=64000,
-                    stream=True
-                )
-                
-                follow_up_content = ""
-                reasoning_started = False
-                
-                for chunk in follow_up_stream:
-                    # Handle reasoning content if available
-                    if hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                        if not reasoning_started:
-                            console.print("\n[bold blue]💭 Reasoning:[/bold blue]")
-                            reasoning_started = True
-                        console.print(chunk.choices[0].delta.reasoning_content, end="")
-                    elif chunk.choices[0].delta.content:
-                        if reasoning_started:
-                            console.print("\n")
-                            console.print("\n[bold bright_blue]🤖 Assistant>[/bold bright_blue] ", end="")
-                            reasoning_started = False
-                        follow_up_content += chunk.choices[0].delta.content
-                        console.print(chunk.choices[0].delta.content, end="")
-                
-                console.print()
-                
-                # Store follow-up response
-                conversation_history.append({
-                    "role": "assistant",
-                    "content": follow_up_content
-                })
-        else:
-            # No tool calls, just store the regular response
-            conversation_history.append(assistant_message)
+            content, tool_calls = run_stream(output, allow_tools=not final_round)
+            
+            # Store the assistant's response in conversation history.
+            # When there are tool calls, content should be None rather than empty
+            assistant_message = {
+                "role": "assistant",
+                "content": content if content else None
+            }
+            if not tool_calls or final_round:
+                # Calls in the final round are never executed, since their results could not be sent back
+                if tool_calls:
+                    console.print("[yellow]⚠ Ignoring function calls requested after the last round[/yellow]")
+                    assistant_message["content"] = content
+                append_message(assistant_message)
+                break
+            assistant_message["tool_calls"] = tool_calls
+            append_message(assistant_message)
+            execute_tool_calls(tool_calls)
 
         return {"success": True}
 
     except Exception as e:
+        output.flush()
         error_msg = f"DeepSeek API error: {str(e)}"
         console.print(f"\n[bold red]❌ {error_msg}[/bold red]")
         
@@ -908,6 +1299,20 @@ def stream_openai_response(user_message: str):
 # 7. Main interactive loop
 # --------------------------------------------------------------------------------
 
+def show_token_usage() -> None:
+    current = get_conversation_tokens()
+    console.print(f"\n[bold cyan]📊 Token Usage:[/bold cyan]")
+    console.print(f"Current: {current:,} / {MAX_CONTEXT_TOKENS:,} ({current/MAX_CONTEXT_TOKENS*100:.1f}%)")
+    console.print(f"Available: {MAX_CONTEXT_TOKENS - current:,} tokens")
+    console.print(f"Messages in history: {len(conversation_history)}\n")
+
+EXIT_COMMANDS = frozenset({"exit", "quit"})
+
+# Lower-cased command -> handler taking no arguments
+COMMANDS = {
+    "/tokens": show_token_usage,
+}
+
 def main():
     # Create a beautiful gradient-style welcome panel
     welcome_text = """[bold bright_blue]🐋 DeepSeek Engineer[/bold bright_blue] [bright_cyan]with Function Calling[/bright_cyan]
@@ -946,7 +1351,7 @@ def main():
         title_align="left"
     ))
     
-    if not use_prompt_toolkit:
+    if get_prompt_session() is None:
         console.print("\n[yellow]⚠ Note: Running without prompt_toolkit auto-completion support.[/yellow]")
         console.print("[yellow]For best experience, run from Windows Terminal, Command Prompt, or Git Bash.[/yellow]\n")
     
@@ -962,16 +1367,14 @@ def main():
         if not user_input:
             continue
 
-        if user_input.lower() in ["exit", "quit"]:
+        command = user_input.lower()
+        if command in EXIT_COMMANDS:
             console.print("[bold bright_blue]👋 Goodbye! Happy coding![/bold bright_blue]")
             break
             
-        if user_input.lower() == "/tokens":
-            current = get_conversation_tokens()
-            console.print(f"\n[bold cyan]📊 Token Usage:[/bold cyan]")
-            console.print(f"Current: {current:,} / {MAX_CONTEXT_TOKENS:,} ({current/MAX_CONTEXT_TOKENS*100:.1f}%)")
-            console.print(f"Available: {MAX_CONTEXT_TOKENS - current:,} tokens")
-            console.print(f"Messages in history: {len(conversation_history)}\n")
+        handler = COMMANDS.get(command)
+        if handler is not None:
+            handler()
             continue
 
         if try_handle_add_command(user_input):